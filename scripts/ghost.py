@@ -6,28 +6,34 @@
 from __future__ import print_function
 
 import argparse
+import collections
 import contextlib
 import ctypes
 import ctypes.util
+import errno
 import fcntl
 import hashlib
+import heapq
+import io
 import json
 import logging
+import math
 import os
 import platform
-import Queue
 import re
 import select
 import signal
 import socket
+import SocketServer
 import ssl
+import stat
 import struct
 import subprocess
 import sys
+import tempfile
 import termios
 import threading
 import time
-import traceback
 import tty
 import urllib2
 import uuid
@@ -35,6 +41,12 @@ import uuid
 import jsonrpclib
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer
 
+# Optional, speeds up encoding and decoding of protocol messages.
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
 
 _GHOST_RPC_PORT = int(os.getenv('GHOST_RPC_PORT', 4499))
 
@@ -42,8 +54,11 @@ _OVERLORD_PORT = int(os.getenv('OVERLORD_PORT', 4455))
 _OVERLORD_LAN_DISCOVERY_PORT = int(os.getenv('OVERLORD_LD_PORT', 4456))
 _OVERLORD_HTTP_PORT = int(os.getenv('OVERLORD_HTTP_PORT', 9000))
 
-_BUFSIZE = 8192
+_BUFSIZE = 64 * 1024
 _RETRY_INTERVAL = 2
+_TRACEBACK_REPEAT_LIMIT = 10
+_SCAN_SERVER_CACHE_SECS = 30
+_MACHINE_ID_CACHE_SECS = 30
 _SEPARATOR = '\r\n'
 _PING_TIMEOUT = 3
 _PING_INTERVAL = 5
@@ -53,18 +68,100 @@ _DEFAULT_BIND_ADDRESS = 'localhost'
 
 _CONTROL_START = 128
 _CONTROL_END = 129
+_CONTROL_START_CHAR = chr(_CONTROL_START)
+_CONTROL_END_CHAR = chr(_CONTROL_END)
 
-_BLOCK_SIZE = 4096
+_BLOCK_SIZE = 1024 * 1024
 _CONNECT_TIMEOUT = 3
+# Interval range for checking whether a shell command which closed its output
+# has exited
+_SHELL_EXIT_POLL_MIN = 0.001
+_SHELL_EXIT_POLL_MAX = 0.5
+
+# Stack size of the RPC request threads
+_THREAD_STACK_SIZE = 256 * 1024
+
+# TCP keepalive, used to detect connections silently dropped by NAT
+_KEEPALIVE_IDLE = 30
+_KEEPALIVE_INTERVAL = 10
+_KEEPALIVE_COUNT = 3
+# Give up on unacknowledged data after as long as keepalive takes to give up
+_USER_TIMEOUT_MS = (_KEEPALIVE_IDLE +
+                    _KEEPALIVE_INTERVAL * _KEEPALIVE_COUNT) * 1000
 
 # Stream control
 _STDIN_CLOSED = '##STDIN_CLOSED##'
 
+_SERVER_URL_RE = re.compile(r'^https?://([^:/]+):')
+_DARWIN_GATEWAY_RE = re.compile(r'gateway: (.*)')
+_DARWIN_SERIAL_NUMBER_RE = re.compile(r'"IOPlatformSerialNumber" = "(.*)"')
+
+# Not available in the socket module of Python 2
+_SOCK_CLOEXEC = getattr(socket, 'SOCK_CLOEXEC', 0)
+_TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT', 18)
+
+# clock_gettime() clock ID from <linux/time.h>
+_CLOCK_MONOTONIC = 1
+
+# (pid, handler) of the cached GhostRPCServer() handler
+_ghost_rpc_server = None
+
 SUCCESS = 'success'
 FAILED = 'failed'
 DISCONNECTED = 'disconnected'
 
 
+def SetCloseOnExec(fd):
+  """Mark a file descriptor close-on-exec."""
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def CreateSocket(family, sock_type):
+  """Create a socket which is not inherited by exec'ed programs."""
+  if _SOCK_CLOEXEC:
+    return socket.socket(family, sock_type | _SOCK_CLOEXEC)
+  sock = socket.socket(family, sock_type)
+  SetCloseOnExec(sock.fileno())
+  return sock
+
+
+class _Timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _GetMonotonicClock():
+  """Returns a function reading CLOCK_MONOTONIC in seconds.
+
+  Falls back to time.time if clock_gettime is not available.
+  """
+  if platform.system() != 'Linux':
+    return time.time
+
+  # Older glibc only provides clock_gettime in librt.
+  for lib in ('c', 'rt'):
+    try:
+      clock_gettime = ctypes.CDLL(ctypes.util.find_library(lib)).clock_gettime
+      break
+    except (OSError, AttributeError):
+      pass
+  else:
+    return time.time
+
+  clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+  def Monotonic():
+    ts = _Timespec()
+    if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+      return time.time()
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+  return Monotonic
+
+
+_monotonic = _GetMonotonicClock()
+
+
 class PingTimeoutError(Exception):
   pass
 
@@ -74,46 +171,222 @@ class RequestError(Exception):
 
 
 class BufferedSocket(object):
-  """A buffered socket that supports unrecv.
+  """A buffered socket.
 
-  Allow putting back data back to the socket for the next recv() call.
+  Data received ahead of time is kept in a buffer and returned by the next
+  Recv() or RecvBuf() call.
   """
   def __init__(self, sock):
     self.sock = sock
-    self._buf = ''
+    self._buf = bytearray()
+    # Data before this offset has been consumed. It is only removed from the
+    # buffer once the offset grows past _BUFSIZE, so consuming a message
+    # doesn't move the rest of the buffer.
+    self._buf_start = 0
+    self._scratch = bytearray(_BUFSIZE)
+    self._scratch_view = memoryview(self._scratch)
+    # Plain sockets are read and written through the file descriptor directly
+    # to skip the socket object overhead. TLS sockets must go through the SSL
+    # layer.
+    self._fd = None if isinstance(sock, ssl.SSLSocket) else sock.fileno()
 
   def fileno(self):
     return self.sock.fileno()
 
   def Recv(self, bufsize, flags=0):
+    self._Compact()
     if self._buf:
       if len(self._buf) >= bufsize:
-        ret = self._buf[:bufsize]
-        self._buf = self._buf[bufsize:]
+        ret = bytes(self._buf[:bufsize])
+        del self._buf[:bufsize]
         return ret
       else:
-        ret = self._buf
-        self._buf = ''
-        return ret + self.sock.recv(bufsize - len(ret), flags)
+        ret = bytes(self._buf)
+        del self._buf[:]
+        return ret + self._Recv(bufsize - len(ret), flags)
     else:
-      return self.sock.recv(bufsize, flags)
+      return self._Recv(bufsize, flags)
 
-  def UnRecv(self, buf):
-    self._buf = buf + self._buf
+  def _Recv(self, bufsize, flags):
+    if self._fd is not None and not flags:
+      return os.read(self._fd, bufsize)
+    return self.sock.recv(bufsize, flags)
 
-  def Send(self, *args, **kwargs):
-    return self.sock.send(*args, **kwargs)
+  def RecvIntoBuf(self, flags=0):
+    """Receive data from the socket and append it to the buffer.
+
+    Returns:
+      Number of bytes received, 0 if the connection is closed.
+    """
+    n = self.sock.recv_into(self._scratch, _BUFSIZE, flags)
+    if self._buf_start > _BUFSIZE:
+      self._Compact()
+    self._buf += self._scratch_view[:n]
+    return n
+
+  def PeekBuf(self):
+    """Returns the buffered data without consuming it.
+
+    Returns:
+      A (buffer, start) tuple, the buffered data begins at offset start of
+      buffer.
+    """
+    return self._buf, self._buf_start
+
+  def ConsumeBuf(self, size):
+    """Discard the first size bytes of the buffered data."""
+    self._buf_start += size
+    if self._buf_start >= len(self._buf):
+      del self._buf[:]
+      self._buf_start = 0
+
+  def _Compact(self):
+    """Remove consumed data from the buffer."""
+    if self._buf_start:
+      del self._buf[:self._buf_start]
+      self._buf_start = 0
+
+  def SendAll(self, *args, **kwargs):
+    return self.sock.sendall(*args, **kwargs)
+
+  def SendFile(self, f):
+    """Send the rest of file f.
+
+    Plain sockets on Linux use sendfile(2), which doesn't copy the data through
+    user space. Otherwise, or if sendfile(2) fails part way, e.g. with
+    EOVERFLOW for large files on 32-bit systems, the rest of the file is read
+    and sent from the current file position.
+    """
+    if self._fd is not None and platform.system() == 'Linux':
+      self._SendFileWithSendfile(f)
+
+    while True:
+      data = f.read(_BLOCK_SIZE)
+      if not data:
+        break
+      self.SendAll(data)
+
+  def _SendFileWithSendfile(self, f):
+    """Send as much of file f as possible with sendfile(2).
+
+    The file position is left after the last byte sent.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    # sendfile64 takes a 64-bit offset, so it works for files over 2 GiB on
+    # 32-bit systems as well.
+    try:
+      sendfile = libc.sendfile64
+    except AttributeError:
+      sendfile = libc.sendfile
+    sendfile.restype = ctypes.c_ssize_t
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                         ctypes.c_size_t]
+
+    in_fd = f.fileno()
+    try:
+      while True:
+        n = sendfile(self._fd, in_fd, None, _BLOCK_SIZE)
+        if n == 0:
+          return
+        elif n > 0:
+          continue
+
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+          continue
+        elif err == errno.EAGAIN:
+          select.select([], [self._fd], [])
+        else:
+          logging.debug('sendfile: %s, falling back to read',
+                        os.strerror(err))
+          return
+    finally:
+      # sendfile(2) advanced the file descriptor, sync the file object to it.
+      try:
+        f.seek(os.lseek(in_fd, 0, os.SEEK_CUR))
+      except (IOError, OSError):
+        # Not seekable, sendfile(2) can't have read from it.
+        pass
 
   def RecvBuf(self):
     """Only recive from buffer."""
-    ret = self._buf
-    self._buf = ''
+    self._Compact()
+    ret = bytes(self._buf)
+    del self._buf[:]
     return ret
 
   def Close(self):
     self.sock.close()
 
 
+class Poller(object):
+  """Wait for file objects to become readable.
+
+  Uses epoll where available, so the set of file objects is only passed to the
+  kernel once, and falls back to select elsewhere. File objects can be file
+  descriptors or objects with a fileno() method.
+  """
+  def __init__(self):
+    self._objs = {}
+    self._epoll = None
+    if hasattr(select, 'epoll'):
+      self._epoll = select.epoll()
+      SetCloseOnExec(self._epoll.fileno())
+
+  def Register(self, obj):
+    fd = obj if isinstance(obj, int) else obj.fileno()
+    self._objs[fd] = obj
+    if self._epoll:
+      self._epoll.register(fd, select.EPOLLIN)
+
+  def Unregister(self, obj):
+    fd = obj if isinstance(obj, int) else obj.fileno()
+    del self._objs[fd]
+    if self._epoll:
+      self._epoll.unregister(fd)
+
+  def Poll(self, timeout=None):
+    """Returns the list of readable file objects.
+
+    Args:
+      timeout: seconds to wait, or None to wait forever.
+    """
+    if self._epoll:
+      if timeout is None:
+        timeout = -1
+      else:
+        # epoll truncates the timeout to milliseconds, round it up so that we
+        # don't wake up right before a deadline.
+        timeout = math.ceil(timeout * 1000) / 1000.0
+      events = self._epoll.poll(timeout)
+      return [self._objs[fd] for fd, unused_event in events]
+    rds, unused_wd, unused_xd = select.select(self._objs.values(), [], [],
+                                              timeout)
+    return rds
+
+  def Close(self):
+    if self._epoll:
+      self._epoll.close()
+
+
+class JSONRPCServer(SocketServer.ThreadingMixIn, SimpleJSONRPCServer):
+  """A SimpleJSONRPCServer which handles each request in its own thread, and
+  whose listening socket is not inherited by exec'ed programs."""
+  daemon_threads = True
+
+  def server_bind(self):
+    SetCloseOnExec(self.socket.fileno())
+    # RPC messages are small, don't let Nagle's algorithm delay them.
+    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    SimpleJSONRPCServer.server_bind(self)
+
+  def get_request(self):
+    request, client_address = SimpleJSONRPCServer.get_request(self)
+    # Not every platform lets accepted sockets inherit TCP_NODELAY.
+    request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return request, client_address
+
+
 class TLSSettings(object):
   def __init__(self, tls_cert_file, verify):
     """Constructor.
@@ -219,32 +492,54 @@ class Ghost(object):
 
     self._platform = platform.system()
     self._overlord_addrs = overlord_addrs
+    self._overlord_addrs_set = set(overlord_addrs)
+    self._scan_server_cache = {}
     self._connected_addr = None
     self._tls_settings = tls_settings
     self._mid = mid
     self._sock = None
     self._mode = mode
     self._machine_id = self.GetMachineID()
+    self._mid_cache = (self._machine_id, self.Timestamp())
     self._session_id = sid if sid is not None else str(uuid.uuid4())
     self._terminal_session_id = terminal_sid
     self._ttyname_to_sid = {}
     self._terminal_sid_to_pid = {}
     self._prop_file = prop_file
     self._properties = {}
+    # (mtime, size) of the properties file when it was last loaded
+    self._prop_file_stat = None
     self._register_status = DISCONNECTED
     self._reset = threading.Event()
     self._tls_mode = tls_mode
 
     # RPC
     self._requests = {}
-    self._queue = Queue.Queue()
+    self._request_deadlines = []
+    # Outgoing messages buffered by SendMessage(), None if not buffering
+    self._send_buf = None
+    if ujson:
+      self._json_encode, self._json_decode = ujson.dumps, ujson.loads
+    else:
+      self._json_encode = json.JSONEncoder(separators=(',', ':')).encode
+      self._json_decode = json.loads
+    self._rpc_server = None
+    # Pipe written by RPC handlers to wake up the main loop, see Wakeup()
+    self._wakeup_r = None
+    self._wakeup_w = None
+
+    # LAN discovery
+    self._lan_sock = None
+    self._lan_buf = None
 
     # Protocol specific
     self._last_ping = 0
     self._tty_device = tty_device
     self._shell_command = command
     self._file_op = file_op
-    self._download_queue = Queue.Queue()
+    # Filled by RPC request threads, consumed by the main loop. deque append
+    # and popleft are atomic, so no lock is needed.
+    self._download_queue = collections.deque()
     self._port = port
 
   def SetIgnoreChild(self, status):
@@ -254,12 +549,15 @@ class Ghost(object):
                     signal.SIG_IGN if status else signal.SIG_DFL)
 
   def GetFileSha1(self, filename):
-    with open(filename, 'r') as f:
-      return hashlib.sha1(f.read()).hexdigest()
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(_BLOCK_SIZE), ''):
+        sha1.update(block)
+    return sha1.hexdigest()
 
   def TLSEnabled(self, host, port):
     """Determine if TLS is enabled on given server address."""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock = CreateSocket(socket.AF_INET, socket.SOCK_STREAM)
     try:
       # Allow any certificate since we only want to check if server talks TLS.
       context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
@@ -317,56 +615,85 @@ class Ghost(object):
       logging.info('Upgrade: ghost is already up-to-date, skipping upgrade')
       return
 
-    # Download upgrade version of ghost.py
+    # Download upgrade version of ghost.py into a temporary file next to the
+    # script, so the script can be replaced atomically.
+    realpath = os.path.realpath(scriptpath)
     try:
-      with contextlib.closing(
-          urllib2.urlopen(url, timeout=_CONNECT_TIMEOUT,
-                          context=self._tls_settings.Context())) as f:
-        if f.getcode() != 200:
-          raise RuntimeError('HTTP status %d' % f.getcode())
-        data = f.read()
-    except (ssl.SSLError, ssl.CertificateError) as e:
-      logging.error('Upgrade: %s: %s', e.__class__.__name__, e)
-      return
+      tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(realpath),
+                                        prefix='.ghost.', delete=False)
     except Exception:
-      logging.error('Upgrade: failed to download upgrade, abort')
-      return
-
-    # Compare SHA1 sum
-    if hashlib.sha1(data).hexdigest() != sha1sum:
-      logging.error('Upgrade: sha1sum mismatch, abort')
+      logging.error('Upgrade: failed to write upgrade onto disk, abort')
       return
 
     try:
-      with open(scriptpath, 'w') as f:
-        f.write(data)
-    except Exception:
-      logging.error('Upgrade: failed to write upgrade onto disk, abort')
-      return
+      try:
+        with tmp, contextlib.closing(
+            urllib2.urlopen(url, timeout=_CONNECT_TIMEOUT,
+                            context=self._tls_settings.Context())) as f:
+          if f.getcode() != 200:
+            raise RuntimeError('HTTP status %d' % f.getcode())
+          # Hash while downloading instead of going over the data again.
+          sha1 = hashlib.sha1()
+          for block in iter(lambda: f.read(_BLOCK_SIZE), ''):
+            sha1.update(block)
+            tmp.write(block)
+          tmp.flush()
+          os.fsync(tmp.fileno())
+      except (ssl.SSLError, ssl.CertificateError) as e:
+        logging.error('Upgrade: %s: %s', e.__class__.__name__, e)
+        return
+      except Exception:
+        logging.error('Upgrade: failed to download upgrade, abort')
+        return
+
+      # Compare SHA1 sum
+      if sha1.hexdigest() != sha1sum:
+        logging.error('Upgrade: sha1sum mismatch, abort')
+        return
+
+      try:
+        os.chmod(tmp.name, stat.S_IMODE(os.stat(realpath).st_mode))
+        os.rename(tmp.name, realpath)
+      except Exception:
+        logging.error('Upgrade: failed to write upgrade onto disk, abort')
+        return
+    finally:
+      if os.path.exists(tmp.name):
+        os.unlink(tmp.name)
 
     logging.info('Upgrade: restarting ghost...')
-    self.CloseSockets()
+    self.FlushMessages()
+    self.CloseFileDescriptors()
     self.SetIgnoreChild(False)
     os.execve(scriptpath, [scriptpath] + sys.argv[1:], os.environ)
 
   def LoadProperties(self):
     try:
       if self._prop_file:
+        # Called on every reconnect attempt, only parse the file again if it
+        # has changed.
+        st = os.stat(self._prop_file)
+        prop_file_stat = (st.st_mtime, st.st_size)
+        if prop_file_stat == self._prop_file_stat:
+          return
         with open(self._prop_file, 'r') as f:
           self._properties = json.loads(f.read())
+        self._prop_file_stat = prop_file_stat
     except Exception as e:
       logging.error('LoadProperties: ' + str(e))
 
-  def CloseSockets(self):
-    # Close sockets opened by parent process, since we don't use it anymore.
+  def CloseFileDescriptors(self):
+    # Close sockets and other file descriptors opened by parent process, since
+    # we don't use them anymore. Standard streams are kept.
     if self._platform == 'Linux':
       for fd in os.listdir('/proc/self/fd/'):
-        try:
-          real_fd = os.readlink('/proc/self/fd/%s' % fd)
-          if real_fd.startswith('socket'):
-            os.close(int(fd))
-        except Exception:
-          pass
+        fd = int(fd)
+        if fd > 2:
+          try:
+            os.close(fd)
+          except OSError:
+            # The descriptor used to list the directory is already closed.
+            pass
 
   def SpawnGhost(self, mode, sid=None, terminal_sid=None, tty_device=None,
                  command=None, file_op=None, port=None):
@@ -380,7 +707,7 @@ class Ghost(object):
 
     pid = os.fork()
     if pid == 0:
-      self.CloseSockets()
+      self.CloseFileDescriptors()
       g = Ghost([self._connected_addr], tls_settings=self._tls_settings,
                 mode=mode, mid=Ghost.RANDOM_MID, sid=sid,
                 terminal_sid=terminal_sid, tty_device=tty_device,
@@ -391,30 +718,50 @@ class Ghost(object):
       self.SetIgnoreChild(True)
       return pid
 
+  def SetSocketOptions(self, sock):
+    """Tune the overlord connection for small, latency sensitive messages."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if self._platform == 'Linux':
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, _KEEPALIVE_IDLE)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                      _KEEPALIVE_INTERVAL)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, _KEEPALIVE_COUNT)
+      # Keepalive only probes idle connections, also time out writes which
+      # are never acknowledged, e.g. a file upload to a vanished server.
+      try:
+        sock.setsockopt(socket.IPPROTO_TCP, _TCP_USER_TIMEOUT, _USER_TIMEOUT_MS)
+      except socket.error:
+        pass
+
   def Timestamp(self):
-    return int(time.time())
+    """Returns the time in seconds used for deadlines and intervals.
+
+    The clock is monotonic where possible, so wall clock adjustments do not
+    fire spurious timeouts or skip pings.
+    """
+    return _monotonic()
 
   def GetGateWayIP(self):
     if self._platform == 'Darwin':
       output = subprocess.check_output(['route', '-n', 'get', 'default'])
-      ret = re.search('gateway: (.*)', output)
+      ret = _DARWIN_GATEWAY_RE.search(output)
       if ret:
         return [ret.group(1)]
     elif self._platform == 'Linux':
-      with open('/proc/net/route', 'r') as f:
-        lines = f.readlines()
-
       ips = []
-      for line in lines:
-        parts = line.split('\t')
-        if parts[2] == '00000000':
-          continue
+      with open('/proc/net/route', 'rb') as f:
+        # Skip the header line.
+        next(f, None)
+        for line in f:
+          parts = line.split('\t', 3)
+          if len(parts) < 3 or parts[2] == '00000000':
+            continue
 
-        try:
-          h = parts[2].decode('hex')
-          ips.append('%d.%d.%d.%d' % tuple(ord(x) for x in reversed(h)))
-        except TypeError:
-          pass
+          try:
+            ips.append(socket.inet_ntoa(struct.pack('<I', int(parts[2], 16))))
+          except ValueError:
+            pass
 
       return ips
     else:
@@ -427,7 +774,7 @@ class Ghost(object):
       from cros.factory.test import server_proxy
 
       url = server_proxy.GetServerURL()
-      match = re.match(r'^https?://(.*):.*$', url)
+      match = _SERVER_URL_RE.match(url)
       if match:
         return [match.group(1)]
     except Exception:
@@ -456,7 +803,7 @@ class Ghost(object):
     if self._platform == 'Darwin':
       output = subprocess.check_output(['ioreg', '-rd1', '-c',
                                         'IOPlatformExpertDevice'])
-      ret = re.search('"IOPlatformSerialNumber" = "(.*)"', output)
+      ret = _DARWIN_SERIAL_NUMBER_RE.search(output)
       if ret:
         return ret.group(1)
 
@@ -492,6 +839,16 @@ class Ghost(object):
 
     raise RuntimeError("can't generate machine ID")
 
+  def _GetCachedMachineID(self):
+    """Returns the machine ID, only regenerating it if it is older than
+    _MACHINE_ID_CACHE_SECS."""
+    now = self.Timestamp()
+    machine_id, timestamp = self._mid_cache
+    if machine_id is None or now - timestamp > _MACHINE_ID_CACHE_SECS:
+      machine_id = self.GetMachineID()
+      self._mid_cache = (machine_id, now)
+    return machine_id
+
   def GetProcessWorkingDirectory(self, pid):
     if self._platform == 'Linux':
       return os.readlink('/proc/%d/cwd' % pid)
@@ -517,13 +874,30 @@ class Ghost(object):
       self._sock = None
     self._reset.clear()
     self._last_ping = 0
-    self._requests = {}
+    self._requests.clear()
+    del self._request_deadlines[:]
+    self._send_buf = None
     self.LoadProperties()
     self._register_status = DISCONNECTED
 
   def SendMessage(self, msg):
-    """Serialize the message and send it through the socket."""
-    self._sock.Send(json.dumps(msg) + _SEPARATOR)
+    """Serialize the message and send it through the socket.
+
+    While a batch of received messages is being handled, outgoing messages are
+    buffered and sent together by FlushMessages().
+    """
+    data = self._json_encode(msg) + _SEPARATOR
+    if self._send_buf is not None:
+      self._send_buf.append(data)
+    else:
+      self._sock.SendAll(data)
+
+  def FlushMessages(self):
+    """Send messages buffered by SendMessage() with a single write."""
+    if self._send_buf:
+      data = ''.join(self._send_buf)
+      del self._send_buf[:]
+      self._sock.SendAll(data)
 
   def SendRequest(self, name, args, handler=None,
                   timeout=_REQUEST_TIMEOUT_SECS):
@@ -533,7 +907,9 @@ class Ghost(object):
     rid = str(uuid.uuid4())
     msg = {'rid': rid, 'timeout': timeout, 'name': name, 'params': args}
     if timeout >= 0:
-      self._requests[rid] = [self.Timestamp(), timeout, handler]
+      request_time = self.Timestamp()
+      self._requests[rid] = [request_time, timeout, handler]
+      heapq.heappush(self._request_deadlines, (request_time + timeout, rid))
     self.SendMessage(msg)
 
   def SendResponse(self, omsg, status, params=None):
@@ -592,42 +968,82 @@ class Ghost(object):
         attr[5] = termios.B115200
         termios.tcsetattr(fd, termios.TCSANOW, attr)
 
+      # Terminal output is drained until EAGAIN on each wakeup, so that a burst
+      # of output is sent with a single SendAll.
+      fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+      def _WriteAll(data):
+        view = memoryview(data)
+        while view:
+          try:
+            view = view[os.write(fd, view):]
+          except OSError as e:
+            if e.errno != errno.EAGAIN:
+              raise
+            # The terminal input queue is full, wait until it drains.
+            select.select([], [fd], [])
+
       nonlocals = {'control_state': None, 'control_str': ''}
 
       def _ProcessBuffer(buf):
-        write_buffer = ''
-        while buf:
+        segments = []
+        pos = 0
+        buf_len = len(buf)
+        # Walk the buffer once, splitting it into terminal data and control
+        # strings without re-slicing the remaining tail.
+        while pos < buf_len:
           if nonlocals['control_state']:
-            if chr(_CONTROL_END) in buf:
-              index = buf.index(chr(_CONTROL_END))
-              nonlocals['control_str'] += buf[:index]
-              self.HandleTTYControl(fd, nonlocals['control_str'])
-              nonlocals['control_state'] = None
-              nonlocals['control_str'] = ''
-              buf = buf[index+1:]
-            else:
-              nonlocals['control_str'] += buf
-              buf = ''
+            index = buf.find(_CONTROL_END_CHAR, pos)
+            if index < 0:
+              nonlocals['control_str'] += buf[pos:]
+              break
+            nonlocals['control_str'] += buf[pos:index]
+            self.HandleTTYControl(fd, nonlocals['control_str'])
+            nonlocals['control_state'] = None
+            nonlocals['control_str'] = ''
           else:
-            if chr(_CONTROL_START) in buf:
-              nonlocals['control_state'] = _CONTROL_START
-              index = buf.index(chr(_CONTROL_START))
-              write_buffer += buf[:index]
-              buf = buf[index+1:]
-            else:
-              write_buffer += buf
-              buf = ''
+            index = buf.find(_CONTROL_START_CHAR, pos)
+            if index < 0:
+              segments.append(buf[pos:])
+              break
+            segments.append(buf[pos:index])
+            nonlocals['control_state'] = _CONTROL_START
+          pos = index + 1
 
+        write_buffer = ''.join(segments)
         if write_buffer:
-          os.write(fd, write_buffer)
+          _WriteAll(write_buffer)
 
       _ProcessBuffer(self._sock.RecvBuf())
 
+      poller = Poller()
+      poller.Register(self._sock)
+      poller.Register(fd)
+
+      # Terminal output is read into a preallocated buffer.
+      tty_file = io.FileIO(fd, 'r', closefd=False)
+      out_buf = bytearray(_BUFSIZE)
+      out_view = memoryview(out_buf)
+
       while True:
-        rd, unused_wd, unused_xd = select.select([self._sock, fd], [], [])
+        rd = poller.Poll()
 
         if fd in rd:
-          self._sock.Send(os.read(fd, _BUFSIZE))
+          n = 0
+          while n < _BUFSIZE:
+            try:
+              # None if no more data is available.
+              count = tty_file.readinto(out_view[n:])
+            except IOError:
+              # The terminal is gone, send what we have got first.
+              if not n:
+                raise
+              break
+            if not count:
+              break
+            n += count
+          self._sock.SendAll(out_view[:n])
 
         if self._sock in rd:
           buf = self._sock.Recv(_BUFSIZE)
@@ -655,27 +1071,38 @@ class Ghost(object):
     os.chdir(os.getenv('HOME', '/tmp'))
 
     p = subprocess.Popen(self._shell_command, stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                          shell=True, env=env)
 
-    def make_non_block(fd):
-      fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-      fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
-    make_non_block(p.stdout)
-    make_non_block(p.stderr)
+    fl = fcntl.fcntl(p.stdout, fcntl.F_GETFL)
+    fcntl.fcntl(p.stdout, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
     try:
       p.stdin.write(self._sock.RecvBuf())
 
+      poller = Poller()
+      poller.Register(p.stdout)
+      poller.Register(self._sock)
+
+      # Once the command closes its output there is nothing left to wake us up
+      # when it exits, so poll for that with an increasing interval.
+      stdout_open = True
+      exit_poll_interval = _SHELL_EXIT_POLL_MIN
+
       while True:
-        rd, unused_wd, unused_xd = select.select(
-            [p.stdout, p.stderr, self._sock], [], [])
-        if p.stdout in rd:
-          self._sock.Send(p.stdout.read(_BUFSIZE))
+        if stdout_open:
+          rd = poller.Poll()
+        else:
+          rd = poller.Poll(exit_poll_interval)
+          exit_poll_interval = min(exit_poll_interval * 2, _SHELL_EXIT_POLL_MAX)
 
-        if p.stderr in rd:
-          self._sock.Send(p.stderr.read(_BUFSIZE))
+        if p.stdout in rd:
+          data = p.stdout.read(_BUFSIZE)
+          if data:
+            self._sock.SendAll(data)
+          else:
+            poller.Unregister(p.stdout)
+            stdout_open = False
 
         if self._sock in rd:
           ret = self._sock.Recv(_BUFSIZE)
@@ -688,8 +1115,20 @@ class Ghost(object):
             p.stdin.close()
           except ValueError:
             p.stdin.write(ret)
-        p.poll()
-        if p.returncode != None:
+
+        if p.poll() is not None:
+          # Forward the output left in the pipe. Background processes may
+          # still hold it open, so stop when it is empty instead of at EOF.
+          if stdout_open:
+            try:
+              while True:
+                data = p.stdout.read(_BUFSIZE)
+                if not data:
+                  break
+                self._sock.SendAll(data)
+            except IOError as e:
+              if e.errno != errno.EAGAIN:
+                raise
           break
     except Exception as e:
       logging.error('SpawnShellServer: %s', e)
@@ -734,12 +1173,17 @@ class Ghost(object):
     logging.info('StartDownloadServer: started')
 
     try:
+      # Only send full segments during the transfer, the rest is flushed when
+      # the cork is removed.
+      cork = self._platform == 'Linux'
+      if cork:
+        self._sock.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
       with open(self._file_op[1], 'rb') as f:
-        while True:
-          data = f.read(_BLOCK_SIZE)
-          if not data:
-            break
-          self._sock.Send(data)
+        self._sock.SendFile(f)
+
+      if cork:
+        self._sock.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
     except Exception as e:
       logging.error('StartDownloadServer: %s', e)
     finally:
@@ -765,13 +1209,16 @@ class Ghost(object):
 
         f.write(self._sock.RecvBuf())
 
+        # Nothing else to wait for, just block on the socket. Receive into a
+        # preallocated buffer to avoid allocating a string for every block.
+        buf = bytearray(_BLOCK_SIZE)
+        view = memoryview(buf)
+        recv_into = self._sock.sock.recv_into
         while True:
-          rd, unused_wd, unused_xd = select.select([self._sock], [], [])
-          if self._sock in rd:
-            buf = self._sock.Recv(_BLOCK_SIZE)
-            if not buf:
-              break
-            f.write(buf)
+          n = recv_into(buf)
+          if not n:
+            break
+          f.write(view[:n])
     except socket.error as e:
       logging.error('StartUploadServer: socket error: %s', e)
     except Exception as e:
@@ -788,26 +1235,35 @@ class Ghost(object):
 
     src_sock = None
     try:
-      src_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      src_sock = CreateSocket(socket.AF_INET, socket.SOCK_STREAM)
+      src_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
       src_sock.settimeout(_CONNECT_TIMEOUT)
       src_sock.connect(('localhost', self._port))
 
-      src_sock.send(self._sock.RecvBuf())
+      src_sock.sendall(self._sock.RecvBuf())
+
+      poller = Poller()
+      poller.Register(self._sock)
+      poller.Register(src_sock)
+
+      # Both directions are forwarded through one preallocated buffer.
+      buf = bytearray(_BUFSIZE)
+      view = memoryview(buf)
 
       while True:
-        rd, unused_wd, unused_xd = select.select([self._sock, src_sock], [], [])
+        rd = poller.Poll()
 
         if self._sock in rd:
-          data = self._sock.Recv(_BUFSIZE)
-          if not data:
+          n = self._sock.sock.recv_into(buf)
+          if not n:
             raise RuntimeError('connection terminated')
-          src_sock.send(data)
+          src_sock.sendall(view[:n])
 
         if src_sock in rd:
-          data = src_sock.recv(_BUFSIZE)
-          if not data:
+          n = src_sock.recv_into(buf)
+          if not n:
             break
-          self._sock.Send(data)
+          self._sock.SendAll(view[:n])
     except Exception as e:
       logging.error('SpawnPortForwardServer: %s', e)
     finally:
@@ -818,12 +1274,12 @@ class Ghost(object):
     logging.info('SpawnPortForwardServer: terminated')
     sys.exit(0)
 
-  def Ping(self):
+  def Ping(self, now):
     def timeout_handler(x):
       if x is None:
         raise PingTimeoutError
 
-    self._last_ping = self.Timestamp()
+    self._last_ping = now
     self.SendRequest('ping', {}, timeout_handler, 5)
 
   def HandleFileDownloadRequest(self, msg):
@@ -912,32 +1368,47 @@ class Ghost(object):
       self.SendResponse(msg, SUCCESS)
 
   def HandleResponse(self, response):
-    rid = str(response['rid'])
-    if rid in self._requests:
-      handler = self._requests[rid][2]
-      del self._requests[rid]
-      if callable(handler):
-        handler(response)
-    else:
+    # Decoded rids are unicode, which hash and compare equal to the str keys.
+    request = self._requests.pop(response['rid'], None)
+    if request is None:
       logging.warning('Received unsolicited response, ignored')
+      return
 
-  def ParseMessage(self, buf, single=True):
-    if single:
-      try:
-        index = buf.index(_SEPARATOR)
-      except ValueError:
-        self._sock.UnRecv(buf)
-        return
-
-      msgs_json = [buf[:index]]
-      self._sock.UnRecv(buf[index + 2:])
-    else:
-      msgs_json = buf.split(_SEPARATOR)
-      self._sock.UnRecv(msgs_json.pop())
+    handler = request[2]
+    if callable(handler):
+      handler(response)
+
+  def ParseMessage(self, single=True):
+    buf, start = self._sock.PeekBuf()
+    view = memoryview(buf)
+    msgs_json = []
+    begin = start
+    while True:
+      index = buf.find(_SEPARATOR, start)
+      if index < 0:
+        break
+      # Copy the message out of the buffer once, without an intermediate
+      # bytearray slice.
+      msgs_json.append(view[start:index].tobytes())
+      start = index + len(_SEPARATOR)
+      if single:
+        break
+    # The buffer can't be resized while it is exported to a memoryview.
+    del view
+
+    # Consume parsed messages before handling them, since handlers may take
+    # over the socket and read the rest of the buffer with RecvBuf().
+    self._sock.ConsumeBuf(start - begin)
+
+    # Send the replies to a batch of messages together. Not flushed when a
+    # handler raises: either the connection is going down, or we are a forked
+    # child unwinding the parent's stack and must not touch its socket.
+    if len(msgs_json) > 1:
+      self._send_buf = []
 
     for msg_json in msgs_json:
       try:
-        msg = json.loads(msg_json)
+        msg = self._json_decode(msg_json)
       except ValueError:
         # Ignore mal-formed message.
         logging.error('mal-formed JSON request, ignored')
@@ -950,48 +1421,84 @@ class Ghost(object):
       else:  # Ingnore mal-formed message.
         logging.error('mal-formed JSON request, ignored')
 
-  def ScanForTimeoutRequests(self):
-    """Scans for pending requests which have timed out.
+    if self._send_buf is not None:
+      self.FlushMessages()
+      self._send_buf = None
+
+  def ScanForTimeoutRequests(self, now):
+    """Scans for pending requests which have timed out at time now.
 
     If any timed-out requests are discovered, their handler is called with the
     special response value of None.
     """
-    for rid in self._requests.keys()[:]:
-      request_time, timeout, handler = self._requests[rid]
-      if self.Timestamp() - request_time > timeout:
-        if callable(handler):
-          handler(None)
-        else:
-          logging.error('Request %s timeout', rid)
-        del self._requests[rid]
+    deadlines = self._request_deadlines
+    while deadlines and deadlines[0][0] <= now:
+      unused_deadline, rid = heapq.heappop(deadlines)
+      request = self._requests.pop(rid, None)
+      if request is None:
+        # Already responded.
+        continue
+      handler = request[2]
+      if callable(handler):
+        handler(None)
+      else:
+        logging.error('Request %s timeout', rid)
 
   def InitiateDownload(self):
-    ttyname, filename = self._download_queue.get()
+    ttyname, filename = self._download_queue.popleft()
     sid = self._ttyname_to_sid[ttyname]
     self.SpawnGhost(self.FILE, terminal_sid=sid,
                     file_op=('download', filename))
 
   def Listen(self):
+    # The socket and RPC server stay the same until we return, look them up
+    # once.
+    sock = self._sock
+    rpc_server = self._rpc_server
+    wakeup_r = self._wakeup_r
+    is_agent = self._mode == self.AGENT
+
+    poller = Poller()
+    poller.Register(sock)
+    if rpc_server:
+      poller.Register(rpc_server)
+    # RPC handlers wake us up for Reconnect and download requests.
+    if wakeup_r is not None:
+      poller.Register(wakeup_r)
+    poll = poller.Poll
+
     try:
       while True:
-        rds, unused_wd, unused_xd = select.select([self._sock], [], [],
-                                                  _PING_INTERVAL / 2)
+        # Sleep until the next ping or request timeout is due.
+        deadline = self._last_ping + _PING_INTERVAL if is_agent else None
+        if self._request_deadlines:
+          request_deadline = self._request_deadlines[0][0]
+          if deadline is None or request_deadline < deadline:
+            deadline = request_deadline
+        timeout = (None if deadline is None else
+                   max(0, deadline - self.Timestamp()))
+
+        rds = poll(timeout)
 
-        if self._sock in rds:
-          data = self._sock.Recv(_BUFSIZE)
+        if rpc_server in rds:
+          self.HandleRPCRequest()
 
+        if wakeup_r in rds:
+          os.read(wakeup_r, _BUFSIZE)
+
+        if sock in rds:
           # Socket is closed
-          if not data:
+          if not sock.RecvIntoBuf():
             break
 
-          self.ParseMessage(data, self._register_status != SUCCESS)
+          self.ParseMessage(self._register_status != SUCCESS)
 
-        if (self._mode == self.AGENT and
-            self.Timestamp() - self._last_ping > _PING_INTERVAL):
-          self.Ping()
-        self.ScanForTimeoutRequests()
+        now = self.Timestamp()
+        if is_agent and now - self._last_ping >= _PING_INTERVAL:
+          self.Ping(now)
+        self.ScanForTimeoutRequests(now)
 
-        if not self._download_queue.empty():
+        while self._download_queue:
           self.InitiateDownload()
 
         if self._reset.is_set():
@@ -1001,18 +1508,15 @@ class Ghost(object):
     except PingTimeoutError:
       raise RuntimeError('Connection timeout')
     finally:
+      poller.Close()
       self.Reset()
 
-    self._queue.put('resume')
-
     if self._mode != Ghost.AGENT:
       sys.exit(1)
 
   def Register(self):
-    non_local = {}
     for addr in self._overlord_addrs:
-      non_local['addr'] = addr
-      def registered(response):
+      def registered(response, addr=addr):
         if response is None:
           self._reset.set()
           raise RuntimeError('Register request timeout')
@@ -1022,10 +1526,11 @@ class Ghost(object):
           self._reset.set()
           raise RuntimeError('Register: ' + response['response'])
         else:
-          logging.info('Registered with Overlord at %s:%d', *non_local['addr'])
-          self._connected_addr = non_local['addr']
+          logging.info('Registered with Overlord at %s:%d', *addr)
+          self._connected_addr = addr
+          # Probe for servers again as soon as we get disconnected.
+          self._scan_server_cache.clear()
           self.Upgrade()  # Check for upgrade
-          self._queue.put('pause', True)
 
       try:
         logging.info('Trying %s:%d ...', *addr)
@@ -1040,8 +1545,9 @@ class Ghost(object):
               self.TLSEnabled(*addr) if self._tls_mode is None
               else self._tls_mode)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = CreateSocket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(_CONNECT_TIMEOUT)
+        self.SetSocketOptions(sock)
 
         try:
           if self._tls_settings.Enabled():
@@ -1071,7 +1577,7 @@ class Ghost(object):
 
         # Machine ID may change if MAC address is used (USB-ethernet dongle
         # plugged/unplugged)
-        self._machine_id = self.GetMachineID()
+        self._machine_id = self._GetCachedMachineID()
         self.SendRequest('register',
                          {'mode': self._mode, 'mid': self._machine_id,
                           'sid': self._session_id,
@@ -1087,6 +1593,7 @@ class Ghost(object):
   def Reconnect(self):
     logging.info('Received reconnect request from RPC server, reconnecting...')
     self._reset.set()
+    self.Wakeup()
 
   def GetStatus(self):
     status = self._register_status
@@ -1096,7 +1603,8 @@ class Ghost(object):
     return status
 
   def AddToDownloadQueue(self, ttyname, filename):
-    self._download_queue.put((ttyname, filename))
+    self._download_queue.append((ttyname, filename))
+    self.Wakeup()
 
   def RegisterTTY(self, session_id, ttyname):
     self._ttyname_to_sid[ttyname] = session_id
@@ -1106,66 +1614,150 @@ class Ghost(object):
 
   def StartLanDiscovery(self):
     """Start to listen to LAN discovery packet at
-    _OVERLORD_LAN_DISCOVERY_PORT."""
+    _OVERLORD_LAN_DISCOVERY_PORT.
 
-    def thread_func():
-      s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-      s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-      s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-      try:
-        s.bind(('0.0.0.0', _OVERLORD_LAN_DISCOVERY_PORT))
-      except socket.error as e:
-        logging.error('LAN discovery: %s, abort', e)
-        return
+    Packets are handled by WaitForOverlordAddrs() while we are disconnected.
+    """
+    s = CreateSocket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    try:
+      s.bind(('0.0.0.0', _OVERLORD_LAN_DISCOVERY_PORT))
+    except socket.error as e:
+      logging.error('LAN discovery: %s, abort', e)
+      s.close()
+      return
 
-      logging.info('LAN Discovery: started')
-      while True:
-        rd, unused_wd, unused_xd = select.select([s], [], [], 1)
+    logging.info('LAN Discovery: started')
+    self._lan_sock = s
+    self._lan_buf = bytearray(_BUFSIZE)
 
-        if s in rd:
-          data, source_addr = s.recvfrom(_BUFSIZE)
-          parts = data.split()
-          if parts[0] == 'OVERLORD':
-            ip, port = parts[1].split(':')
-            if not ip:
-              ip = source_addr[0]
-            self._queue.put((ip, int(port)), True)
+  def HandleLanDiscovery(self):
+    """Handle pending LAN discovery packets.
 
-        try:
-          obj = self._queue.get(False)
-        except Queue.Empty:
-          pass
-        else:
-          if not isinstance(obj, str):
-            self._queue.put(obj)
-          elif obj == 'pause':
-            logging.info('LAN Discovery: paused')
-            while obj != 'resume':
-              obj = self._queue.get(True)
-            logging.info('LAN Discovery: resumed')
-
-    t = threading.Thread(target=thread_func)
-    t.daemon = True
-    t.start()
+    Returns:
+      True if a new overlord address is found.
+    """
+    found = False
+    buf = self._lan_buf
+    recvfrom_into = self._lan_sock.recvfrom_into
+    add_overlord_addr = self.AddOverlordAddr
+    # Drain every pending packet so a burst of announcements costs a single
+    # wakeup.
+    while True:
+      try:
+        n, source_addr = recvfrom_into(buf, _BUFSIZE, socket.MSG_DONTWAIT)
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        raise
+
+      # Packet format: 'OVERLORD [ip]:port'
+      if not buf.startswith('OVERLORD ', 0, n):
+        continue
+      ip, unused_sep, port = str(buf[9:n]).partition(':')
+      try:
+        port = int(port)
+      except ValueError:
+        continue
+      addr = (ip or source_addr[0], port)
+      if add_overlord_addr(addr):
+        logging.info('LAN Discovery: got overlord address %s:%d', *addr)
+        found = True
+    return found
 
   def StartRPCServer(self):
+    """Start the RPC server.
+
+    Incoming connections are accepted from the main loop, see
+    HandleRPCRequest().
+    """
     logging.info('RPC Server: started')
-    rpc_server = SimpleJSONRPCServer((_DEFAULT_BIND_ADDRESS, _GHOST_RPC_PORT),
-                                     logRequests=False)
+    rpc_server = JSONRPCServer((_DEFAULT_BIND_ADDRESS, _GHOST_RPC_PORT),
+                               logRequests=False)
     rpc_server.register_function(self.Reconnect, 'Reconnect')
     rpc_server.register_function(self.GetStatus, 'GetStatus')
     rpc_server.register_function(self.RegisterTTY, 'RegisterTTY')
     rpc_server.register_function(self.RegisterSession, 'RegisterSession')
     rpc_server.register_function(self.AddToDownloadQueue, 'AddToDownloadQueue')
-    t = threading.Thread(target=rpc_server.serve_forever)
-    t.daemon = True
-    t.start()
+    self._rpc_server = rpc_server
+
+    self._wakeup_r, self._wakeup_w = os.pipe()
+    for fd in (self._wakeup_r, self._wakeup_w):
+      SetCloseOnExec(fd)
+    fl = fcntl.fcntl(self._wakeup_w, fcntl.F_GETFL)
+    fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+  def Wakeup(self):
+    """Wake up the main loop from an RPC handler thread."""
+    if self._wakeup_w is None:
+      return
+    try:
+      os.write(self._wakeup_w, 'x')
+    except OSError as e:
+      # The pipe is full, the main loop is going to wake up anyway.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def HandleRPCRequest(self):
+    """Accept a pending RPC connection, which is served in its own thread."""
+    self._rpc_server._handle_request_noblock()  # pylint: disable=protected-access
+
+  def AddOverlordAddr(self, addr):
+    """Add an overlord address to try.
+
+    Returns:
+      True if the address is new, False if it is already known.
+    """
+    if addr in self._overlord_addrs_set:
+      return False
+    self._overlord_addrs_set.add(addr)
+    self._overlord_addrs.append(addr)
+    return True
 
   def ScanServer(self):
+    now = self.Timestamp()
     for meth in [self.GetGateWayIP, self.GetFactoryServerIP]:
-      for addr in [(x, _OVERLORD_PORT) for x in meth()]:
-        if addr not in self._overlord_addrs:
-          self._overlord_addrs.append(addr)
+      # Results are cached to avoid probing again on every reconnect attempt.
+      timestamp, ips = self._scan_server_cache.get(meth.__name__, (0, None))
+      if ips is None or now - timestamp > _SCAN_SERVER_CACHE_SECS:
+        ips = meth()
+        self._scan_server_cache[meth.__name__] = (now, ips)
+
+      for addr in [(x, _OVERLORD_PORT) for x in ips]:
+        self.AddOverlordAddr(addr)
+
+  def WaitForOverlordAddrs(self, timeout):
+    """Wait for LAN discovery to find new overlord addresses.
+
+    RPC requests are served while waiting. Returns as soon as a new address is
+    found or an RPC handler calls Wakeup(), or after timeout seconds.
+    """
+    poller = Poller()
+    for obj in (self._lan_sock, self._rpc_server, self._wakeup_r):
+      if obj is not None:
+        poller.Register(obj)
+
+    deadline = self.Timestamp() + timeout
+    try:
+      while True:
+        remaining = deadline - self.Timestamp()
+        if remaining <= 0:
+          return
+
+        rds = poller.Poll(remaining)
+
+        if self._rpc_server in rds:
+          self.HandleRPCRequest()
+
+        if self._lan_sock in rds and self.HandleLanDiscovery():
+          return
+
+        if self._wakeup_r in rds:
+          os.read(self._wakeup_r, _BUFSIZE)
+          return
+    finally:
+      poller.Close()
 
   def Start(self, lan_disc=False, rpc_server=False):
     logging.info('%s started', self.MODE_NAME[self._mode])
@@ -1182,50 +1774,78 @@ class Ghost(object):
     if rpc_server:
       self.StartRPCServer()
 
+    last_error = None
+    repeat_count = 0
     try:
       while True:
-        try:
-          addr = self._queue.get(False)
-        except Queue.Empty:
-          pass
-        else:
-          if isinstance(addr, tuple) and addr not in self._overlord_addrs:
-            logging.info('LAN Discovery: got overlord address %s:%d', *addr)
-            self._overlord_addrs.append(addr)
-
         try:
           self.ScanServer()
           self.Register()
         # Don't show stack trace for RuntimeError, which we use in this file for
         # plausible and expected errors (such as can't connect to server).
         except RuntimeError as e:
-          logging.info('%s, retrying in %ds', e.message, _RETRY_INTERVAL)
-          time.sleep(_RETRY_INTERVAL)
+          logging.info('%s, retrying in %ds', e, _RETRY_INTERVAL)
         except Exception as e:
-          unused_x, unused_y, exc_traceback = sys.exc_info()
-          traceback.print_tb(exc_traceback)
-          logging.info('%s: %s, retrying in %ds',
-                       e.__class__.__name__, e.message, _RETRY_INTERVAL)
-          time.sleep(_RETRY_INTERVAL)
+          # Only show the stack trace once for an error that keeps repeating.
+          error = (e.__class__.__name__, str(e))
+          if error == last_error and repeat_count < _TRACEBACK_REPEAT_LIMIT:
+            repeat_count += 1
+            logging.info('%s: %s (repeat %d), retrying in %ds',
+                         error[0], error[1], repeat_count, _RETRY_INTERVAL)
+          else:
+            last_error = error
+            repeat_count = 0
+            logging.exception('%s: %s, retrying in %ds',
+                              error[0], error[1], _RETRY_INTERVAL)
 
         self.Reset()
+        self.WaitForOverlordAddrs(_RETRY_INTERVAL)
     except KeyboardInterrupt:
       logging.error('Received keyboard interrupt, quit')
       sys.exit(0)
 
 
 def GhostRPCServer():
-  """Returns handler to Ghost's JSON RPC server."""
-  return jsonrpclib.Server('http://localhost:%d' % _GHOST_RPC_PORT)
+  """Returns handler to Ghost's JSON RPC server.
+
+  The handler is reused by later calls from the same process, so its HTTP
+  connection can be kept alive. It is not shared with forked children.
+  """
+  global _ghost_rpc_server  # pylint: disable=global-statement
+  pid = os.getpid()
+  if _ghost_rpc_server is None or _ghost_rpc_server[0] != pid:
+    _ghost_rpc_server = (
+        pid, jsonrpclib.Server('http://localhost:%d' % _GHOST_RPC_PORT))
+  return _ghost_rpc_server[1]
 
 
 def ForkToBackground():
-  """Fork process to run in background."""
+  """Fork process to run in background.
+
+  The process forks twice with a setsid() in between, so the background
+  process is detached from the controlling terminal and, not being a session
+  leader, can never acquire a new one.
+  """
   pid = os.fork()
   if pid != 0:
-    logging.info('Ghost(%d) running in background.', pid)
+    # Reap the intermediate child so it does not linger as a zombie.
+    os.waitpid(pid, 0)
     sys.exit(0)
 
+  os.setsid()
+  pid = os.fork()
+  if pid != 0:
+    logging.info('Ghost(%d) running in background.', pid)
+    os._exit(0)  # pylint: disable=protected-access
+
+  # Release the terminal we were started from. Standard streams redirected to
+  # files or pipes are kept so logs still go where the caller asked.
+  devnull = os.open(os.devnull, os.O_RDWR)
+  for fd in (0, 1, 2):
+    if os.isatty(fd):
+      os.dup2(devnull, fd)
+  os.close(devnull)
+
 
 def DownloadFile(filename):
   """Initiate a client-initiated file download."""
@@ -1313,6 +1933,10 @@ def main():
   tls_settings = TLSSettings(args.tls_cert_file, not args.tls_no_verify)
   tls_mode = args.tls_mode
   tls_mode = {'y': True, 'n': False, 'detect': None}[tls_mode]
+  # RPC request threads only run shallow call stacks, don't reserve the default
+  # (usually 8 MiB) stack for each of them.
+  threading.stack_size(_THREAD_STACK_SIZE)
+
   g = Ghost(addrs, tls_settings, Ghost.AGENT, args.mid,
             prop_file=prop_file, tls_mode=tls_mode)
   g.Start(args.lan_disc, args.rpc_server)